@@ -2,6 +2,7 @@ import os
 import asyncpg
 import logging
 from fastapi import FastAPI, HTTPException
+from fastapi.openapi.utils import get_openapi
 from pydantic import BaseModel
 from datetime import datetime, timedelta
 from typing import List, Dict, Any
@@ -9,6 +10,9 @@ import uvicorn
 import pandas as pd
 from prophet import Prophet
 import asyncio
+import tracemalloc
+
+import profiling
 
 app = FastAPI(
     title="Forecasting Service",
@@ -85,6 +89,7 @@ async def list_available_metrics():
     return {"available_metrics": available_metrics}
 
 @app.post("/forecast/{metric_name}")
+@profiling.debug_request("forecast")
 async def forecast_metric(metric_name: str, request: ForecastRequest = ForecastRequest()):
     """
     Main forecasting endpoint
@@ -170,6 +175,7 @@ async def forecast_metric(metric_name: str, request: ForecastRequest = ForecastR
         raise HTTPException(status_code=500, detail=f"Forecasting failed: {str(e)}")
 
 @app.post("/detect_anomalies/{metric_name}")
+@profiling.debug_request("detect_anomalies")
 async def detect_anomalies(metric_name: str, hours_back: int = 24):
     """
     Anomaly detection endpoint - compares recent actual values against forecast.
@@ -255,6 +261,115 @@ async def detect_anomalies(metric_name: str, hours_back: int = 24):
             raise
         raise HTTPException(status_code=500, detail=f"Anomaly detection failed: {str(e)}")
 
+def _require_debug_enabled():
+    """
+    Debug endpoints are hidden unless the service was started with FORECASTING_DEBUG set.
+    """
+    if not profiling.DEBUG_ENABLED:
+        raise HTTPException(status_code=404, detail="Not Found")
+
+async def _run_profiled(endpoint: str, metric_name: str, profiler: str, limit: int, interval_ms: float, trace_memory: bool, handler):
+    """
+    Helper function to run a single endpoint execution under the requested profiler.
+    Errors raised by the endpoint are reported alongside the profile instead of aborting it.
+    """
+    _require_debug_enabled()
+    if profiler not in profiling.PROFILERS:
+        raise HTTPException(status_code=400, detail=f"Unknown profiler '{profiler}'. Available profilers: {list(profiling.PROFILERS)}")
+    if interval_ms <= 0:
+        raise HTTPException(status_code=400, detail="interval_ms must be greater than 0.")
+    if limit <= 0:
+        raise HTTPException(status_code=400, detail="limit must be greater than 0.")
+
+    status_code, result = 200, None
+    try:
+        with profiling.profile_request(endpoint, metric_name, profiler, interval_ms / 1000, trace_memory) as info:
+            # Timings taken while tracemalloc runs (also during a tracemalloc session) are inflated.
+            traced_memory = tracemalloc.is_tracing()
+            try:
+                result = await handler()
+            except HTTPException as e:
+                status_code, result = e.status_code, {"detail": e.detail}
+    except profiling.ProfilingInProgress as e:
+        raise HTTPException(status_code=409, detail=f"Profiling unavailable: {str(e)}")
+
+    return {
+        "endpoint": endpoint,
+        "metric": metric_name,
+        "status_code": status_code,
+        "result": result,
+        "traced_memory": traced_memory,
+        "stages": info.stages,
+        "profile": info.profiler.report(limit),
+    }
+
+@app.post("/debug/profile/forecast/{metric_name}")
+async def profile_forecast(metric_name: str, request: ForecastRequest = ForecastRequest(), profiler: str = "cprofile", limit: int = 25, interval_ms: float = 5.0, trace_memory: bool = False):
+    """
+    Run /forecast once under a deterministic (cprofile) or sampling profiler and return
+    the top call stacks together with the per-stage timings (and, with trace_memory,
+    the per-stage peak allocations).
+    """
+    return await _run_profiled("forecast", metric_name, profiler, limit, interval_ms, trace_memory, lambda: forecast_metric(metric_name, request))
+
+@app.post("/debug/profile/detect_anomalies/{metric_name}")
+async def profile_detect_anomalies(metric_name: str, hours_back: int = 24, profiler: str = "cprofile", limit: int = 25, interval_ms: float = 5.0, trace_memory: bool = False):
+    """
+    Run /detect_anomalies once under a deterministic (cprofile) or sampling profiler and
+    return the top call stacks together with the per-stage timings (and, with
+    trace_memory, the per-stage peak allocations).
+    """
+    return await _run_profiled("detect_anomalies", metric_name, profiler, limit, interval_ms, trace_memory, lambda: detect_anomalies(metric_name, hours_back))
+
+@app.post("/debug/tracemalloc/start")
+async def tracemalloc_start(frames: int = 1):
+    """
+    Start tracing allocations and take a baseline snapshot. While tracing, every
+    /forecast and /detect_anomalies request records the peak allocation of its stages.
+    """
+    _require_debug_enabled()
+    if not 1 <= frames <= 65535:
+        raise HTTPException(status_code=400, detail="frames must be between 1 and 65535.")
+    session = profiling.start_tracemalloc(frames)
+    return {"status": "tracing", "frames": session.frames, "started_at": session.started_at}
+
+@app.get("/debug/tracemalloc/snapshot")
+async def tracemalloc_snapshot(limit: int = 10, group_by: str = "lineno"):
+    """
+    Take a snapshot and diff it against both the baseline and the previous snapshot,
+    so memory growth can be attributed to the N requests served in between.
+    """
+    _require_debug_enabled()
+    if group_by not in ("lineno", "filename", "traceback"):
+        raise HTTPException(status_code=400, detail=f"Invalid group_by '{group_by}'. Use 'lineno', 'filename' or 'traceback'.")
+    if limit <= 0:
+        raise HTTPException(status_code=400, detail="limit must be greater than 0.")
+    session = profiling.get_tracemalloc_session()
+    if session is None or not tracemalloc.is_tracing():
+        raise HTTPException(status_code=409, detail="tracemalloc is not running. POST /debug/tracemalloc/start first.")
+    return session.snapshot(limit, group_by)
+
+@app.post("/debug/tracemalloc/stop")
+async def tracemalloc_stop():
+    """
+    Stop tracing allocations and discard the snapshots.
+    """
+    _require_debug_enabled()
+    session = profiling.stop_tracemalloc()
+    return {"status": "stopped", "requests_traced": session.requests if session else 0}
+
+def custom_openapi():
+    """
+    Generate the OpenAPI schema, leaving the /debug endpoints out of it (and out of /docs)
+    unless debugging is enabled. Not cached, since DEBUG_ENABLED is read on every call.
+    """
+    schema = get_openapi(title=app.title, version=app.version, description=app.description, routes=app.routes)
+    if not profiling.DEBUG_ENABLED:
+        schema["paths"] = {path: item for path, item in schema["paths"].items() if not path.startswith("/debug/")}
+    return schema
+
+app.openapi = custom_openapi
+
 async def connect_to_timescaledb():
     """
     Initialize database connection pool using DATABASE_URL from environment variables.
@@ -312,6 +427,7 @@ async def fetch_metric_data(metric_name: str, hours_back: int = 24 * 7) -> List[
         # Re-raise as HTTPException to be caught by FastAPI's error handling
         raise HTTPException(status_code=500, detail=f"Failed to fetch historical data for metric '{metric_name}': {str(e)}")
 
+@profiling.profiled_worker
 def run_prophet_forecast(historical_data: List[Dict[str, Any]], hours_ahead: int, confidence_interval: float):
     """
     Run Prophet forecasting model
@@ -324,25 +440,29 @@ def run_prophet_forecast(historical_data: List[Dict[str, Any]], hours_ahead: int
     5. Generate predictions
     6. Return original dataframe and forecast dataframe
     """
+    # The profiling.stage blocks only record timings and allocations when debugging is enabled.
     # 1. Convert data to pandas DataFrame
-    df = pd.DataFrame(historical_data)
-    df.rename(columns={'timestamp': 'ds', 'value': 'y'}, inplace=True)
+    with profiling.stage("build_dataframe"):
+        df = pd.DataFrame(historical_data)
+        df.rename(columns={'timestamp': 'ds', 'value': 'y'}, inplace=True)
 
-    # Ensure 'ds' is datetime (and timezone-naive) and 'y' is numeric
-    df['ds'] = pd.to_datetime(df['ds']).dt.tz_localize(None)
-    df['y'] = pd.to_numeric(df['y'])
+        # Ensure 'ds' is datetime (and timezone-naive) and 'y' is numeric
+        df['ds'] = pd.to_datetime(df['ds']).dt.tz_localize(None)
+        df['y'] = pd.to_numeric(df['y'])
 
     # 2. Initialize Prophet
     m = Prophet(interval_width=confidence_interval)
 
     # 3. Fit model
-    m.fit(df)
+    with profiling.stage("fit"):
+        m.fit(df)
 
-    # 4. Create future dataframe
-    future = m.make_future_dataframe(periods=hours_ahead, freq='H')
+    with profiling.stage("predict"):
+        # 4. Create future dataframe
+        future = m.make_future_dataframe(periods=hours_ahead, freq='H')
 
-    # 5. Generate predictions
-    forecast = m.predict(future)
+        # 5. Generate predictions
+        forecast = m.predict(future)
 
     # 6. Return both dataframes
     return df, forecast
@@ -0,0 +1,456 @@
+"""
+On-demand profiling and memory introspection for the forecasting service.
+
+Everything in here is off unless the FORECASTING_DEBUG environment variable is set
+to a truthy value. DEBUG_ENABLED is read on every call, so the /debug endpoints in
+main.py and the hooks on the request path always agree. When disabled, the endpoints
+respond with 404 and each hook costs a single flag or ContextVar lookup.
+
+The state kept here is process-wide (tracemalloc is global to the interpreter), so the
+numbers are only meaningful on a quiet worker: concurrent requests will show up in
+each other's profiles and allocation peaks.
+"""
+
+import cProfile
+import functools
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+DEBUG_ENABLED = os.getenv("FORECASTING_DEBUG", "").lower() in ("1", "true", "yes", "on")
+
+PROFILERS = ("cprofile", "sampling")
+
+# Number of per-request stage reports kept while a tracemalloc session is running.
+MAX_REQUEST_REPORTS = 100
+
+# tracemalloc is shared by the tracemalloc session and by the profiling runs that asked
+# for allocation tracing; it is only stopped once the last of them is done.
+_tracemalloc_lock = threading.Lock()
+_tracemalloc_users = 0
+_tracemalloc_owned = False
+
+# Highest traced peak seen before a stage reset it. tracemalloc.reset_peak() is
+# process-wide, so the session peak has to be carried across the resets.
+_carried_peak = 0
+
+# Only one profiling run at a time: on Python 3.11 a second cProfile.Profile silently
+# takes over the thread's profile hook, on 3.12+ it refuses to enable.
+_profiling_lock = threading.Lock()
+_profiling_active = False
+
+# Per-request debug state. It is set by the request scope (or by a profiling run) and,
+# because asyncio.to_thread copies the current context, it is also visible from the
+# worker thread that runs Prophet.
+_current_request: ContextVar[Optional["RequestDebugInfo"]] = ContextVar("forecasting_debug_request", default=None)
+
+
+class ProfilingInProgress(RuntimeError):
+    """
+    Raised when a profiling run is requested while another one is still active.
+    """
+
+
+class RequestDebugInfo:
+    """
+    Debug information collected for a single /forecast or /detect_anomalies execution.
+    """
+
+    def __init__(self, endpoint: str, metric_name: str, profiler=None):
+        self.endpoint = endpoint
+        self.metric_name = metric_name
+        self.profiler = profiler
+        self.started_at = datetime.now()
+        self.stages: Dict[str, Dict[str, float]] = {}
+
+    def report(self) -> Dict[str, Any]:
+        return {
+            "endpoint": self.endpoint,
+            "metric": self.metric_name,
+            "started_at": self.started_at,
+            "stages": self.stages,
+        }
+
+
+class _CProfileProfiler:
+    """
+    Deterministic profiler. One cProfile.Profile per participating thread, merged at the end.
+    """
+
+    def __init__(self):
+        self._profiles: List[cProfile.Profile] = []
+        self._lock = threading.Lock()
+        self._main = cProfile.Profile()
+
+    def start(self):
+        try:
+            self._main.enable()
+        except ValueError as e:
+            # Another sys.monitoring based profiler (3.12+) holds the hook.
+            raise ProfilingInProgress(str(e)) from e
+
+    def stop(self):
+        self._main.disable()
+        if self._main not in self._profiles:
+            self._profiles.append(self._main)
+
+    @contextmanager
+    def worker(self):
+        # On interpreters where cProfile is backed by sys.monitoring the main profile
+        # already sees every thread and a second one refuses to enable.
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            yield
+            return
+        try:
+            yield
+        finally:
+            profile.disable()
+            with self._lock:
+                self._profiles.append(profile)
+
+    def report(self, limit: int) -> Dict[str, Any]:
+        stats = pstats.Stats(self._profiles[0], stream=io.StringIO())
+        for profile in self._profiles[1:]:
+            stats.add(profile)
+        stats.sort_stats(pstats.SortKey.CUMULATIVE)
+
+        top = []
+        for func in stats.fcn_list[:limit]:
+            primitive_calls, total_calls, tottime, cumtime, callers = stats.stats[func]
+            top.append({
+                "function": pstats.func_std_string(func),
+                "calls": total_calls,
+                "primitive_calls": primitive_calls,
+                "tottime": tottime,
+                "cumtime": cumtime,
+                "callers": [pstats.func_std_string(caller) for caller in list(callers)[:5]],
+            })
+        return {"profiler": "cprofile", "total_time": stats.total_tt, "top_functions": top}
+
+
+class _SamplingProfiler:
+    """
+    Statistical profiler that periodically samples the stacks of the threads taking part
+    in the request. Much lower overhead than cProfile on Prophet's tight loops.
+
+    Samples are reported per thread, so the event loop idling in the selector while it
+    awaits the worker does not dilute the worker's stacks.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.samples = 0
+        self._stacks: Dict[str, Counter] = {}
+        self._thread_names = {threading.get_ident(): "event_loop"}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="forecasting-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        if self._thread.is_alive():
+            self._stop.set()
+            self._thread.join()
+
+    @contextmanager
+    def worker(self):
+        thread_id = threading.get_ident()
+        self._thread_names[thread_id] = f"worker:{threading.current_thread().name}"
+        try:
+            yield
+        finally:
+            self._thread_names.pop(thread_id, None)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            for thread_id, thread_name in list(self._thread_names.items()):
+                frame = frames.get(thread_id)
+                if frame is None:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_filename}:{frame.f_lineno}({code.co_name})")
+                    frame = frame.f_back
+                self._stacks.setdefault(thread_name, Counter())[tuple(reversed(stack))] += 1
+                self.samples += 1
+
+    def report(self, limit: int) -> Dict[str, Any]:
+        threads = []
+        for thread_name, stacks in self._stacks.items():
+            thread_samples = sum(stacks.values())
+            threads.append({
+                "thread": thread_name,
+                "samples": thread_samples,
+                "top_stacks": [
+                    {"samples": count, "fraction": count / thread_samples, "stack": list(stack)}
+                    for stack, count in stacks.most_common(limit)
+                ],
+            })
+        # Worker threads first: that is where Prophet spends its time.
+        threads.sort(key=lambda thread: thread["thread"] == "event_loop")
+        return {
+            "profiler": "sampling",
+            "interval_seconds": self.interval,
+            "samples": self.samples,
+            "threads": threads,
+        }
+
+
+def _acquire_tracemalloc(frames: int = 1):
+    global _tracemalloc_users, _tracemalloc_owned
+    with _tracemalloc_lock:
+        # Tracing started outside this module (e.g. PYTHONTRACEMALLOC) is never stopped here.
+        if _tracemalloc_users == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+            _tracemalloc_owned = True
+        _tracemalloc_users += 1
+
+
+def _release_tracemalloc():
+    global _tracemalloc_users, _tracemalloc_owned
+    with _tracemalloc_lock:
+        _tracemalloc_users -= 1
+        if _tracemalloc_users == 0 and _tracemalloc_owned:
+            tracemalloc.stop()
+            _tracemalloc_owned = False
+
+
+def _reset_peak() -> int:
+    """
+    Reset the traced peak, carrying the previous one over for the session report.
+    Returns the current traced size.
+    """
+    global _carried_peak
+    with _tracemalloc_lock:
+        current, peak = tracemalloc.get_traced_memory()
+        _carried_peak = max(_carried_peak, peak)
+        tracemalloc.reset_peak()
+        return current
+
+
+@contextmanager
+def request_scope(endpoint: str, metric_name: str):
+    """
+    Collect per-stage allocation peaks for a regular request while a tracemalloc session
+    is running. Does nothing when debugging is disabled or a profiling run is already
+    tracking this request.
+    """
+    session = _tracemalloc_session
+    if not DEBUG_ENABLED or session is None or _current_request.get() is not None:
+        yield
+        return
+
+    info = RequestDebugInfo(endpoint, metric_name)
+    token = _current_request.set(info)
+    try:
+        yield
+    finally:
+        _current_request.reset(token)
+        session.record_request(info)
+
+
+@contextmanager
+def profile_request(endpoint: str, metric_name: str, profiler: str, interval: float = 0.005, trace_memory: bool = False):
+    """
+    Profile everything executed inside the block, including the Prophet worker thread.
+
+    With trace_memory, tracemalloc is kept running for the duration of the run so the
+    stages report their allocation peaks. It slows down every allocation, so it is off
+    by default to keep the timings representative.
+
+    Raises ProfilingInProgress if another profiling run is still active.
+    """
+    global _profiling_active
+    if profiler == "cprofile":
+        active = _CProfileProfiler()
+    elif profiler == "sampling":
+        active = _SamplingProfiler(interval)
+    else:
+        raise ValueError(f"Unknown profiler '{profiler}'. Expected one of {PROFILERS}.")
+
+    with _profiling_lock:
+        if _profiling_active:
+            raise ProfilingInProgress("Another profiling run is already active.")
+        _profiling_active = True
+
+    info = RequestDebugInfo(endpoint, metric_name, profiler=active)
+    token = _current_request.set(info)
+    if trace_memory:
+        _acquire_tracemalloc()
+    try:
+        active.start()
+        yield info
+    finally:
+        active.stop()
+        if trace_memory:
+            _release_tracemalloc()
+        _current_request.reset(token)
+        with _profiling_lock:
+            _profiling_active = False
+
+
+def debug_request(endpoint: str):
+    """
+    Decorator for the endpoints whose executions can be inspected. Runs the endpoint
+    in request_scope, or calls it directly when debugging is disabled.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            if not DEBUG_ENABLED:
+                return await func(*args, **kwargs)
+            with request_scope(endpoint, kwargs.get("metric_name")):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def profiled_worker(func):
+    """
+    Decorator for the synchronous functions run through asyncio.to_thread. Attaches the
+    worker thread to the active profiler, if any.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        info = _current_request.get() if DEBUG_ENABLED else None
+        if info is None or info.profiler is None:
+            return func(*args, **kwargs)
+        with info.profiler.worker():
+            return func(*args, **kwargs)
+    return wrapper
+
+
+@contextmanager
+def stage(name: str):
+    """
+    Record wall time and peak traced allocation of a named stage of the current request.
+    """
+    info = _current_request.get()
+    if info is None:
+        yield
+        return
+
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        # The peak is process-wide, so it is reset at the start of every stage.
+        start_current = _reset_peak()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        result = {"seconds": time.perf_counter() - start}
+        if tracing:
+            current, peak = tracemalloc.get_traced_memory()
+            result["peak_bytes"] = max(peak - start_current, 0)
+            result["retained_bytes"] = current - start_current
+        info.stages[name] = result
+
+
+class TracemallocSession:
+    """
+    A tracemalloc run with a baseline snapshot, used to diff memory across N requests.
+    """
+
+    def __init__(self):
+        global _carried_peak
+        with _tracemalloc_lock:
+            tracemalloc.reset_peak()
+            _carried_peak = 0
+        self.frames = tracemalloc.get_traceback_limit()
+        self.started_at = datetime.now()
+        self.requests = 0
+        self.recent_requests = deque(maxlen=MAX_REQUEST_REPORTS)
+        self.baseline = self._take_snapshot()
+        self.previous = self.baseline
+        self.previous_requests = 0
+
+    @staticmethod
+    def _take_snapshot() -> tracemalloc.Snapshot:
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ))
+
+    def record_request(self, info: RequestDebugInfo):
+        self.requests += 1
+        self.recent_requests.append(info.report())
+
+    def snapshot(self, limit: int, group_by: str) -> Dict[str, Any]:
+        snapshot = self._take_snapshot()
+        with _tracemalloc_lock:
+            current, peak = tracemalloc.get_traced_memory()
+            peak = max(peak, _carried_peak)
+        report = {
+            "started_at": self.started_at,
+            "requests_since_start": self.requests,
+            "requests_since_previous_snapshot": self.requests - self.previous_requests,
+            "traced_current_bytes": current,
+            "traced_peak_bytes": peak,
+            "top_since_start": _format_diff(snapshot.compare_to(self.baseline, group_by), limit),
+            "top_since_previous_snapshot": _format_diff(snapshot.compare_to(self.previous, group_by), limit),
+            "recent_requests": list(self.recent_requests),
+        }
+        self.previous = snapshot
+        self.previous_requests = self.requests
+        return report
+
+
+def _format_diff(stats: List[tracemalloc.StatisticDiff], limit: int) -> List[Dict[str, Any]]:
+    return [
+        {
+            "location": [f"{frame.filename}:{frame.lineno}" for frame in stat.traceback],
+            "size_bytes": stat.size,
+            "size_diff_bytes": stat.size_diff,
+            "count": stat.count,
+            "count_diff": stat.count_diff,
+        }
+        for stat in stats[:limit]
+    ]
+
+
+_tracemalloc_session: Optional[TracemallocSession] = None
+
+
+def start_tracemalloc(frames: int) -> TracemallocSession:
+    """
+    Start tracing allocations and take the baseline snapshot. Restarts any running session.
+
+    frames only applies if tracemalloc is not already tracing for a profiling run; the
+    session reports the traceback limit actually in effect.
+    """
+    global _tracemalloc_session
+    stop_tracemalloc()
+    _acquire_tracemalloc(frames)
+    _tracemalloc_session = TracemallocSession()
+    return _tracemalloc_session
+
+
+def stop_tracemalloc() -> Optional[TracemallocSession]:
+    """
+    Drop the session, freeing the snapshots it holds. Tracing stops unless a profiling
+    run still needs it.
+    """
+    global _tracemalloc_session
+    session, _tracemalloc_session = _tracemalloc_session, None
+    if session is not None:
+        _release_tracemalloc()
+    return session
+
+
+def get_tracemalloc_session() -> Optional[TracemallocSession]:
+    return _tracemalloc_session
@@ -0,0 +1,260 @@
+"""Tests for the /debug profiling and tracemalloc endpoints."""
+
+from unittest.mock import patch, AsyncMock
+import time
+import tracemalloc
+import pandas as pd
+import pytest
+
+import profiling
+
+class FakeProphet:
+    """Stand-in for Prophet that keeps the worker thread busy long enough to be sampled."""
+
+    def __init__(self, interval_width):
+        self.history = None
+
+    def fit(self, df):
+        self.history = df
+        time.sleep(0.05)
+
+    def make_future_dataframe(self, periods, freq):
+        future = pd.date_range(self.history['ds'].max(), periods=periods + 1, freq='h')[1:]
+        return pd.concat([self.history[['ds']], pd.DataFrame({'ds': future})], ignore_index=True)
+
+    def predict(self, future):
+        time.sleep(0.05)
+        return future.assign(yhat=100.0, yhat_lower=90.0, yhat_upper=110.0)
+
+@pytest.fixture
+def debug_enabled(monkeypatch):
+    """Enable the debug endpoints and make sure no tracemalloc session outlives the test."""
+    monkeypatch.setattr(profiling, "DEBUG_ENABLED", True)
+    yield
+    profiling.stop_tracemalloc()
+
+def test_debug_endpoints_disabled_by_default(client, monkeypatch):
+    """Test that the debug endpoints are hidden unless FORECASTING_DEBUG is set."""
+    monkeypatch.setattr(profiling, "DEBUG_ENABLED", False)
+    assert client.post("/debug/profile/forecast/cpu").status_code == 404
+    assert client.post("/debug/tracemalloc/start").status_code == 404
+    assert client.get("/debug/tracemalloc/snapshot").status_code == 404
+
+    paths = client.get("/openapi.json").json()["paths"]
+    assert "/forecast/{metric_name}" in paths
+    assert not [path for path in paths if path.startswith("/debug/")]
+
+def test_debug_endpoints_in_schema_when_enabled(client, debug_enabled):
+    """Test that the debug endpoints are documented once debugging is enabled."""
+    paths = client.get("/openapi.json").json()["paths"]
+    assert "/debug/profile/forecast/{metric_name}" in paths
+    assert "/debug/tracemalloc/snapshot" in paths
+
+@pytest.mark.parametrize("profiler", ["cprofile", "sampling"])
+@patch("main.asyncio.to_thread")
+@patch("main._get_available_metrics_from_db", new_callable=AsyncMock)
+@patch("main.fetch_metric_data", new_callable=AsyncMock)
+def test_profile_forecast(mock_fetch_data, mock_get_metrics, mock_to_thread, profiler, sample_metric_data, client, debug_enabled):
+    """Test that profiling a /forecast execution returns its result and the profile."""
+    test_metric = "test_cpu_usage"
+    mock_get_metrics.return_value = [test_metric]
+    mock_fetch_data.return_value = sample_metric_data
+
+    df = pd.DataFrame(sample_metric_data).rename(columns={'timestamp': 'ds', 'value': 'y'})
+    forecast_df = df.assign(yhat=df['y'], yhat_lower=df['y'] * 0.9, yhat_upper=df['y'] * 1.1)
+    mock_to_thread.return_value = (df, forecast_df)
+
+    response = client.post(f"/debug/profile/forecast/{test_metric}?profiler={profiler}&limit=5")
+
+    assert response.status_code == 200
+    data = response.json()
+    assert data["status_code"] == 200
+    assert data["result"]["metric"] == test_metric
+    assert data["profile"]["profiler"] == profiler
+    assert data["traced_memory"] is False
+    if profiler == "cprofile":
+        assert 0 < len(data["profile"]["top_functions"]) <= 5
+    else:
+        # The mocked request is too quick to sample reliably; see test_profile_forecast_worker_thread.
+        assert all(len(thread["top_stacks"]) <= 5 for thread in data["profile"]["threads"])
+
+@patch("main.Prophet", FakeProphet)
+@patch("main._get_available_metrics_from_db", new_callable=AsyncMock)
+@patch("main.fetch_metric_data", new_callable=AsyncMock)
+def test_profile_forecast_worker_thread(mock_fetch_data, mock_get_metrics, sample_metric_data, client, debug_enabled):
+    """Test that the Prophet worker thread is sampled and its stages are recorded."""
+    test_metric = "test_cpu_usage"
+    mock_get_metrics.return_value = [test_metric]
+    mock_fetch_data.return_value = sample_metric_data
+
+    response = client.post(f"/debug/profile/forecast/{test_metric}?profiler=sampling&interval_ms=1&trace_memory=true")
+
+    assert response.status_code == 200
+    data = response.json()
+    assert data["status_code"] == 200
+    assert data["traced_memory"] is True
+    for stage in ("build_dataframe", "fit", "predict"):
+        assert data["stages"][stage]["peak_bytes"] >= 0
+    assert data["stages"]["build_dataframe"]["peak_bytes"] > 0
+    threads = data["profile"]["threads"]
+    worker = threads[0]
+    assert worker["thread"].startswith("worker:")
+    assert worker["samples"] > 0
+    assert any("run_prophet_forecast" in frame for stack in worker["top_stacks"] for frame in stack["stack"])
+    # The event loop idling in the selector is reported separately, not mixed into the worker.
+    assert sum(stack["samples"] for stack in worker["top_stacks"]) <= worker["samples"]
+    assert all(thread["thread"] != "event_loop" for thread in threads[:-1])
+    # Tracing was only needed for the run.
+    assert not tracemalloc.is_tracing()
+
+@patch("main.Prophet", FakeProphet)
+@patch("main._get_available_metrics_from_db", new_callable=AsyncMock)
+@patch("main.fetch_metric_data", new_callable=AsyncMock)
+def test_profile_forecast_without_trace_memory(mock_fetch_data, mock_get_metrics, sample_metric_data, client, debug_enabled):
+    """Test that allocation tracing is opt-in for profiling runs."""
+    test_metric = "test_cpu_usage"
+    mock_get_metrics.return_value = [test_metric]
+    mock_fetch_data.return_value = sample_metric_data
+
+    data = client.post(f"/debug/profile/forecast/{test_metric}").json()
+
+    assert data["traced_memory"] is False
+    assert "seconds" in data["stages"]["predict"]
+    assert "peak_bytes" not in data["stages"]["predict"]
+
+@patch("main.fetch_metric_data", new_callable=AsyncMock)
+def test_profile_detect_anomalies_reports_errors(mock_fetch_data, client, debug_enabled):
+    """Test that errors raised by the profiled endpoint are reported, not raised."""
+    mock_fetch_data.return_value = []
+    response = client.post("/debug/profile/detect_anomalies/test_cpu_usage")
+    assert response.status_code == 200
+    data = response.json()
+    assert data["status_code"] == 404
+    assert "Not enough data" in data["result"]["detail"]
+
+def test_profile_unknown_profiler(client, debug_enabled):
+    """Test that an unknown profiler is rejected with a 400 error."""
+    response = client.post("/debug/profile/forecast/cpu?profiler=perf")
+    assert response.status_code == 400
+    assert "Unknown profiler" in response.json()["detail"]
+
+def test_profile_rejects_concurrent_runs(client, debug_enabled):
+    """Test that a second profiling run is rejected with a 409 while the first is active."""
+    with profiling.profile_request("forecast", "cpu", "cprofile", trace_memory=True):
+        response = client.post("/debug/profile/forecast/cpu")
+        assert response.status_code == 409
+        assert "already active" in response.json()["detail"]
+        with pytest.raises(profiling.ProfilingInProgress):
+            with profiling.profile_request("forecast", "cpu", "sampling"):
+                pass
+        # The rejected run must not release the tracing the active run still needs.
+        assert tracemalloc.is_tracing()
+    assert not tracemalloc.is_tracing()
+
+    with profiling.profile_request("forecast", "cpu", "cprofile"):
+        pass
+
+def test_profile_request_cleans_up_when_start_fails(debug_enabled):
+    """Test that tracing and the active-run guard are released if the profiler fails to start."""
+    with patch.object(profiling._SamplingProfiler, "start", side_effect=RuntimeError("can't start thread")):
+        with pytest.raises(RuntimeError):
+            with profiling.profile_request("forecast", "cpu", "sampling", trace_memory=True):
+                pass
+    assert not tracemalloc.is_tracing()
+    assert profiling._tracemalloc_users == 0
+    assert profiling._current_request.get() is None
+
+    with profiling.profile_request("forecast", "cpu", "sampling"):
+        pass
+
+def test_debug_invalid_parameters(client, debug_enabled):
+    """Test that out-of-range parameters are rejected with a 400 error."""
+    assert client.post("/debug/profile/forecast/cpu?limit=0").status_code == 400
+    assert client.post("/debug/profile/forecast/cpu?interval_ms=0").status_code == 400
+    assert client.post("/debug/tracemalloc/start?frames=0").status_code == 400
+    assert client.post("/debug/tracemalloc/start?frames=65536").status_code == 400
+    assert client.post("/debug/tracemalloc/start").status_code == 200
+    assert client.get("/debug/tracemalloc/snapshot?limit=-1").status_code == 400
+
+def test_tracemalloc_session(client, debug_enabled):
+    """Test the start/snapshot/stop cycle of a tracemalloc session."""
+    assert client.get("/debug/tracemalloc/snapshot").status_code == 409
+
+    response = client.post("/debug/tracemalloc/start?frames=2")
+    assert response.status_code == 200
+    assert response.json()["frames"] == 2
+
+    response = client.get("/debug/tracemalloc/snapshot?limit=3")
+    assert response.status_code == 200
+    data = response.json()
+    assert data["requests_since_start"] == 0
+    assert len(data["top_since_start"]) <= 3
+    assert "top_since_previous_snapshot" in data
+
+    assert client.get("/debug/tracemalloc/snapshot?group_by=module").status_code == 400
+
+    response = client.post("/debug/tracemalloc/stop")
+    assert response.status_code == 200
+    assert response.json()["status"] == "stopped"
+    assert client.get("/debug/tracemalloc/snapshot").status_code == 409
+
+@patch("main.Prophet", FakeProphet)
+@patch("main._get_available_metrics_from_db", new_callable=AsyncMock)
+@patch("main.fetch_metric_data", new_callable=AsyncMock)
+def test_tracemalloc_session_records_requests(mock_fetch_data, mock_get_metrics, sample_metric_data, client, debug_enabled):
+    """Test that requests served during a session show up in the snapshot."""
+    test_metric = "test_cpu_usage"
+    mock_get_metrics.return_value = [test_metric]
+    mock_fetch_data.return_value = sample_metric_data
+
+    client.post("/debug/tracemalloc/start")
+    assert client.post(f"/forecast/{test_metric}").status_code == 200
+
+    data = client.get("/debug/tracemalloc/snapshot").json()
+    assert data["requests_since_start"] == 1
+    assert data["requests_since_previous_snapshot"] == 1
+    request = data["recent_requests"][0]
+    assert request["endpoint"] == "forecast"
+    assert request["metric"] == test_metric
+    assert request["stages"]["build_dataframe"]["peak_bytes"] > 0
+    assert "peak_bytes" in request["stages"]["predict"]
+
+    data = client.get("/debug/tracemalloc/snapshot").json()
+    assert data["requests_since_previous_snapshot"] == 0
+
+def test_tracemalloc_session_peak_survives_stage_resets(debug_enabled):
+    """Test that stages resetting the tracemalloc peak do not hide the session peak."""
+    session = profiling.start_tracemalloc(1)
+    allocation = bytearray(10 * 1024 * 1024)
+    del allocation
+
+    with profiling.profile_request("forecast", "cpu", "cprofile", trace_memory=True):
+        with profiling.stage("build_dataframe"):
+            pass
+
+    assert session.snapshot(1, "lineno")["traced_peak_bytes"] >= 10 * 1024 * 1024
+
+def test_tracemalloc_shared_between_session_and_profiling_run(client, debug_enabled):
+    """Test that neither a profiling run nor the session stops tracing the other still needs."""
+    with profiling.profile_request("forecast", "cpu", "cprofile", trace_memory=True):
+        client.post("/debug/tracemalloc/start")
+    assert tracemalloc.is_tracing()
+    assert client.get("/debug/tracemalloc/snapshot").status_code == 200
+
+    with profiling.profile_request("forecast", "cpu", "cprofile", trace_memory=True):
+        client.post("/debug/tracemalloc/stop")
+        assert tracemalloc.is_tracing()
+    assert not tracemalloc.is_tracing()
+
+def test_stage_records_peak_allocation():
+    """Test that stages record their peak allocation only inside a profiled request."""
+    with profiling.stage("build_dataframe"):
+        pass  # No active request: nothing is recorded and nothing fails.
+
+    with profiling.profile_request("forecast", "cpu", "cprofile", trace_memory=True) as info:
+        with profiling.stage("build_dataframe"):
+            pd.DataFrame({"y": range(10000)})
+
+    stage = info.stages["build_dataframe"]
+    assert stage["seconds"] >= 0
+    assert stage["peak_bytes"] > 0